@@ -0,0 +1,13 @@
+from django.contrib.auth.backends import ModelBackend
+
+from usercache import get_cached_user
+
+
+class CachedModelBackend(ModelBackend):
+    """
+    ModelBackend that resolves the session user through the user
+    cache instead of querying the database on every request.
+    """
+
+    def get_user(self, user_id):
+        return get_cached_user(user_id, super(CachedModelBackend, self).get_user)
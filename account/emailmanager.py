@@ -12,6 +12,7 @@ from django.template import Context
 from django.core.mail import EmailMessage
 
 from models import AuthenticationKey
+from keyfilter import key_issued
 from settings import DEFAULT_REGISTRATION_KEY_VALID_DAYS
 from settings import DEFAULT_RECOVERY_KEY_VALID_DAYS
 from settings import DEFAULT_DEACTIVATION_KEY_VALID_DAYS
@@ -57,10 +58,11 @@ class EmailManager(object):
         # Generate key and create ActivationKey object.
         activation_key = AuthenticationKey(user=self.owner,
                                       key=self.generate_hash(),
-                                      type='a',
+                                      key_type='a',
                                       used=False,
                                       expires=expiry_date)
         activation_key.save()
+        key_issued(activation_key.key)
 
         # Set up template parameters
         templateFile = "account/email/activation_email.html"
@@ -76,21 +78,23 @@ class EmailManager(object):
 
         return email
 
-    def generate_recovery_email(self):
+    def generate_recovery_key(self):
         """
-        Generate a password recovery email.
+        Generate an unsaved password recovery key.
         """
-        # Allow CONSTANT days for activation.
+        # Allow CONSTANT days for recovery.
         expiry_date = datetime.today() + timedelta(days=DEFAULT_RECOVERY_KEY_VALID_DAYS)
 
-        # Generate key and create ActivationKey object.
-        recovery_key = AuthenticationKey(user=self.owner,
-                                   key=self.generate_hash(),
-                                   type='r',
-                                   used=False,
-                                   expires=expiry_date)
-        recovery_key.save()
+        return AuthenticationKey(user=self.owner,
+                                 key=self.generate_hash(),
+                                 key_type='r',
+                                 used=False,
+                                 expires=expiry_date)
 
+    def render_recovery_email(self, recovery_key):
+        """
+        Render the password recovery email for a key.
+        """
         # Set up template parameters
         template_file = "account/email/recovery_email.html"
         params = {"username": self.owner.username,
@@ -105,6 +109,16 @@ class EmailManager(object):
 
         return email
 
+    def generate_recovery_email(self):
+        """
+        Generate a password recovery email.
+        """
+        recovery_key = self.generate_recovery_key()
+        recovery_key.save()
+        key_issued(recovery_key.key)
+
+        return self.render_recovery_email(recovery_key)
+
     def generate_deactivation_email(self):
         """
         Generate an account deactivation email.
@@ -115,10 +129,11 @@ class EmailManager(object):
         # Generate key and create DeactivationKey object.
         deactivation_key = AuthenticationKey(user=self.owner,
                                            key=self.generate_hash(),
-                                           type='d',
+                                           key_type='d',
                                            used=False,
                                            expires=expiry_date)
         deactivation_key.save()
+        key_issued(deactivation_key.key)
 
         # Set up template parameters
         template_file = "account/email/deactivation_email.html"
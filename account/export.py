@@ -0,0 +1,138 @@
+# export.py
+# Generators that stream users and their authentication
+# key history as CSV or JSON lines in constant memory.
+
+import csv
+import json
+import zlib
+from datetime import date
+
+from django.contrib.auth.models import User
+from django.utils.encoding import smart_str
+
+from models import AuthenticationKey
+from models import KEY_TYPE_CHOICES
+
+
+EXPORT_FORMATS = ("csv", "jsonl")
+DEFAULT_CHUNK_SIZE = 2000
+
+FIELDS = ["id", "username", "email", "is_active", "date_joined"] + \
+    ["%s_%s" % (name.lower(), state)
+     for key_type, name in KEY_TYPE_CHOICES
+     for state in ("issued", "used", "expired")]
+
+
+def user_chunks(chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yield lists of users in primary key order, one chunk
+    at a time, so no more than chunk_size rows are held.
+    Only the exported columns are loaded, leaving out password hashes.
+    """
+    users = User.objects.only("id", "username", "email", "is_active", "date_joined")
+    last_id = 0
+    while True:
+        chunk = list(users.filter(id__gt=last_id).order_by("id")[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        last_id = chunk[-1].id
+
+
+def key_history(first_id, last_id):
+    """
+    Count issued, used and expired keys of each type for
+    users with ids in a range, with a single query.
+
+    Filtering on the range rather than a list of ids keeps the
+    number of bound parameters down, which SQLite caps at 999.
+    """
+    today = date.today()
+    names = dict(KEY_TYPE_CHOICES)
+    history = {}
+    keys = AuthenticationKey.objects.filter(user__gte=first_id, user__lte=last_id)
+    for user_id, key_type, used, expires in keys.values_list("user", "key_type", "used", "expires"):
+        counts = history.setdefault(user_id, {})
+        prefix = names.get(key_type, key_type).lower()
+        counts[prefix + "_issued"] = counts.get(prefix + "_issued", 0) + 1
+        if used:
+            counts[prefix + "_used"] = counts.get(prefix + "_used", 0) + 1
+        elif expires < today:
+            counts[prefix + "_expired"] = counts.get(prefix + "_expired", 0) + 1
+    return history
+
+
+def account_rows(chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yield one dictionary per user with their key history.
+    """
+    for chunk in user_chunks(chunk_size):
+        history = key_history(chunk[0].id, chunk[-1].id)
+        for user in chunk:
+            row = dict.fromkeys(FIELDS, 0)
+            row.update(history.get(user.id, {}))
+            row["id"] = user.id
+            row["username"] = user.username
+            row["email"] = user.email
+            row["is_active"] = user.is_active
+            row["date_joined"] = user.date_joined.isoformat()
+            yield row
+
+
+class Echo(object):
+    """
+    File-like object that hands back whatever is written to it,
+    so csv.writer can be used to format a single row.
+    """
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(rows):
+    """
+    Format rows as CSV, header first.
+    """
+    writer = csv.writer(Echo())
+    yield writer.writerow(FIELDS)
+    for row in rows:
+        yield writer.writerow([smart_str(row[field]) for field in FIELDS])
+
+
+def jsonl_lines(rows):
+    """
+    Format rows as JSON, one object per line.
+    """
+    for row in rows:
+        yield json.dumps(row) + "\n"
+
+
+def gzip_stream(lines):
+    """
+    Compress a stream of strings into gzip chunks on the fly.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for line in lines:
+        data = compressor.compress(smart_str(line))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def format_lines(rows, export_format="csv"):
+    """
+    Format rows in the requested export format.
+    """
+    if export_format == "jsonl":
+        return jsonl_lines(rows)
+    return csv_lines(rows)
+
+
+def export_accounts(export_format="csv", compress=False, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Return a generator of the formatted, optionally gzipped, export.
+    """
+    lines = format_lines(account_rows(chunk_size), export_format)
+    if compress:
+        return gzip_stream(lines)
+    return lines
@@ -0,0 +1,305 @@
+# keyfilter.py
+# In-process probabilistic filter of live authentication keys,
+# used to reject garbage activation/recovery/deactivation links
+# without touching the database.
+
+import math
+import threading
+import time
+from datetime import datetime
+from hashlib import sha256
+
+from django.core.cache import cache
+
+from models import AuthenticationKey
+from sharedcache import cache_is_shared
+from settings import ACCOUNT_KEY_FILTER_ENABLED
+from settings import ACCOUNT_KEY_FILTER_CAPACITY
+from settings import ACCOUNT_KEY_FILTER_ERROR_RATE
+from settings import ACCOUNT_KEY_FILTER_REFRESH_SECONDS
+from settings import ACCOUNT_KEY_FILTER_REBUILD_SECONDS
+
+
+GENERATION_KEY = "account.keyfilter.generation"
+LOOKUPS_KEY = "account.keyfilter.lookups"
+REJECTIONS_KEY = "account.keyfilter.rejections"
+
+# Newly issued keys are announced in the shared cache for long enough
+# that every process has synced them into its own filter by then.
+ISSUED_TIMEOUT = 2 * ACCOUNT_KEY_FILTER_REFRESH_SECONDS + 60
+
+
+def issued_key(key):
+    return "account.keyfilter.issued.%s" % key
+
+
+class KeyFilter(object):
+    """
+    Bloom filter of authentication keys.
+
+    A negative answer from might_contain() means the key is definitely
+    not live. Keys are never removed, since that could clear bits that
+    belong to other live keys. Used and expired keys drop out when the
+    filter is rebuilt.
+    """
+
+    def __init__(self, capacity, error_rate):
+        """
+        Size the filter for the expected number of
+        live keys and the target false positive rate.
+        """
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_slots = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.num_hashes = max(1, int(round(float(self.num_slots) / capacity * math.log(2))))
+        self.bits = bytearray((self.num_slots + 7) // 8)
+        self.count = 0
+        self.lookups = 0
+        self.rejections = 0
+        self.published_lookups = 0
+        self.published_rejections = 0
+        self.generation = 0
+        self.last_key_id = 0
+        self.previous_key_id = 0
+        self.built = None
+        self.last_sync = None
+        self.lock = threading.Lock()
+
+    def _indexes(self, key):
+        """
+        Derive the bit indexes for a key by double hashing.
+        """
+        digest = sha256(key.encode("utf-8")).hexdigest()
+        h1 = int(digest[:16], 16)
+        h2 = int(digest[16:32], 16) | 1
+        return [(h1 + i * h2) % self.num_slots for i in range(self.num_hashes)]
+
+    def add(self, key):
+        """
+        Add a key to the filter. Keys that are already
+        present are not counted again.
+        """
+        with self.lock:
+            added = False
+            for i in self._indexes(key):
+                mask = 1 << (i & 7)
+                if not self.bits[i >> 3] & mask:
+                    self.bits[i >> 3] |= mask
+                    added = True
+            if added:
+                self.count += 1
+
+    def might_contain(self, key):
+        """
+        Return False if the key is definitely not in the filter.
+        """
+        return all(self.bits[i >> 3] & (1 << (i & 7)) for i in self._indexes(key))
+
+    def estimated_error_rate(self):
+        """
+        Expected false positive rate at the current fill.
+        """
+        fill = 1 - math.exp(-float(self.num_hashes) * self.count / self.num_slots)
+        return fill ** self.num_hashes
+
+    def stats(self):
+        """
+        Return a dictionary of size and accuracy metrics.
+        """
+        return {"keys": self.count,
+                "capacity": self.capacity,
+                "slots": self.num_slots,
+                "hashes": self.num_hashes,
+                "memory_bytes": len(self.bits),
+                "target_error_rate": self.error_rate,
+                "estimated_error_rate": self.estimated_error_rate(),
+                "lookups": self.lookups,
+                "rejections": self.rejections}
+
+
+def current_generation():
+    return cache.get(GENERATION_KEY, 0)
+
+
+def bump_generation():
+    """
+    Ask every server process to rebuild its filter at its next refresh.
+    """
+    cache.add(GENERATION_KEY, 0, None)
+    return cache.incr(GENERATION_KEY)
+
+
+def build_filter():
+    """
+    Build a new filter holding every unused, unexpired key.
+    It is sized for at least twice the current number of keys.
+    """
+    live_keys = AuthenticationKey.objects.filter(used=False,
+                                                 expires__gte=datetime.today())
+    capacity = max(ACCOUNT_KEY_FILTER_CAPACITY, 2 * live_keys.count())
+    new_filter = KeyFilter(capacity, ACCOUNT_KEY_FILTER_ERROR_RATE)
+    new_filter.generation = current_generation()
+    for key_id, key in live_keys.values_list("id", "key").iterator():
+        new_filter.add(key)
+        new_filter.last_key_id = max(new_filter.last_key_id, key_id)
+    new_filter.previous_key_id = new_filter.last_key_id
+    new_filter.built = new_filter.last_sync = time.time()
+    return new_filter
+
+
+def sync(key_filter):
+    """
+    Add keys issued by other processes since the last syncs.
+
+    Each sync also reads the id range covered by the sync before it.
+    That catches keys whose transactions committed out of id order.
+    Anything later than that is picked up by the next rebuild.
+    """
+    scan_from = key_filter.previous_key_id
+    key_filter.previous_key_id = key_filter.last_key_id
+    new_keys = AuthenticationKey.objects.filter(id__gt=scan_from, used=False)
+    for key_id, key in new_keys.values_list("id", "key").iterator():
+        key_filter.add(key)
+        key_filter.last_key_id = max(key_filter.last_key_id, key_id)
+    key_filter.last_sync = time.time()
+
+
+def publish_stats(key_filter):
+    """
+    Add this process's lookups and rejections since the
+    last call to the totals kept in the shared cache.
+    """
+    for cache_key, attribute in ((LOOKUPS_KEY, "lookups"), (REJECTIONS_KEY, "rejections")):
+        delta = getattr(key_filter, attribute) - getattr(key_filter, "published_" + attribute)
+        if delta:
+            cache.add(cache_key, 0, None)
+            cache.incr(cache_key, delta)
+            setattr(key_filter, "published_" + attribute,
+                    getattr(key_filter, "published_" + attribute) + delta)
+
+
+def published_stats():
+    """
+    Return the lookup and rejection totals of all processes.
+    """
+    return {"lookups": cache.get(LOOKUPS_KEY, 0),
+            "rejections": cache.get(REJECTIONS_KEY, 0)}
+
+
+key_filter = None
+refresh_lock = threading.Lock()
+issued_during_build = None
+
+
+def rebuild_filter():
+    """
+    Swap in a freshly built filter. Keys issued by this process
+    while it was being built are carried over into it.
+    Must be called with refresh_lock held.
+    """
+    global key_filter, issued_during_build
+    issued_during_build = []
+    try:
+        new_filter = build_filter()
+        # Add the pending keys before the swap so lookups can find
+        # them, and again after it for any issued during the swap.
+        for key in issued_during_build:
+            new_filter.add(key)
+        key_filter = new_filter
+        for key in issued_during_build:
+            new_filter.add(key)
+    finally:
+        issued_during_build = None
+
+
+def get_key_filter():
+    """
+    Return this process's filter, refreshing it once every
+    ACCOUNT_KEY_FILTER_REFRESH_SECONDS.
+
+    A refresh rebuilds the filter if it is older than
+    ACCOUNT_KEY_FILTER_REBUILD_SECONDS, holds more keys than it was
+    sized for, or rebuildkeyfilter has been run since it was built.
+    Otherwise it syncs keys issued by other processes. Rebuilds swap
+    in a new filter so lookups never see a half built one.
+    """
+    if key_filter is None:
+        with refresh_lock:
+            if key_filter is None:
+                rebuild_filter()
+        return key_filter
+
+    if time.time() - key_filter.last_sync < ACCOUNT_KEY_FILTER_REFRESH_SECONDS:
+        return key_filter
+
+    # Only one thread refreshes; the others use the filter as it is.
+    if not refresh_lock.acquire(False):
+        return key_filter
+    try:
+        publish_stats(key_filter)
+        if current_generation() != key_filter.generation \
+                or time.time() - key_filter.built >= ACCOUNT_KEY_FILTER_REBUILD_SECONDS \
+                or key_filter.count > key_filter.capacity:
+            rebuild_filter()
+        else:
+            sync(key_filter)
+    finally:
+        refresh_lock.release()
+    return key_filter
+
+
+def publish_issued_key(key):
+    """
+    Announce a newly issued key to other processes, whose
+    filters won't hold it until their next sync.
+    """
+    cache.set(issued_key(key), True, ISSUED_TIMEOUT)
+
+
+def key_issued(key):
+    """
+    Record a newly issued key.
+    """
+    if not ACCOUNT_KEY_FILTER_ENABLED:
+        return
+
+    publish_issued_key(key)
+    pending = issued_during_build
+    if pending is not None:
+        pending.append(key)
+    current_filter = key_filter
+    if current_filter is not None:
+        current_filter.add(key)
+
+
+def recently_issued(key):
+    """
+    Check a key the filter doesn't hold against keys issued since it
+    was last synced. With a shared cache that is a cache lookup.
+    Otherwise other processes' keys can only be seen in the database.
+    """
+    if cache_is_shared():
+        return bool(cache.get(issued_key(key)))
+    return AuthenticationKey.objects.filter(key=key,
+                                            used=False,
+                                            expires__gte=datetime.today()).exists()
+
+
+def key_may_be_live(key):
+    """
+    Return False only if the key is definitely not live.
+    """
+    if not ACCOUNT_KEY_FILTER_ENABLED:
+        return True
+
+    current_filter = get_key_filter()
+    current_filter.lookups += 1
+    if current_filter.might_contain(key):
+        return True
+
+    if recently_issued(key):
+        current_filter.add(key)
+        return True
+
+    current_filter.rejections += 1
+    return False
@@ -0,0 +1,177 @@
+import time
+from optparse import make_option
+
+from django.core.exceptions import FieldError
+from django.core.management.base import CommandError
+from django.core.mail import get_connection
+from django.contrib.auth.models import User
+from django.contrib.auth.hashers import make_password
+from account.models import AuthenticationKey
+from account.emailmanager import EmailManager
+from account.keyfilter import key_issued
+from account.usercache import invalidate_users
+from account.profiler import ProfiledCommand
+
+
+ACTIONS = ("deactivate", "resetpassword")
+
+
+def parse_filters(filters):
+    """
+    Turn field=value strings into queryset filter arguments.
+    """
+    kwargs = {}
+    for item in filters:
+        if "=" not in item:
+            raise CommandError("Filters must look like field=value, not %s." % item)
+        field, value = item.split("=", 1)
+        if value.lower() in ("true", "false"):
+            value = value.lower() == "true"
+        kwargs[field] = value
+    return kwargs
+
+
+def read_ids(filename):
+    """
+    Read one user id per line, ignoring blank lines.
+    """
+    try:
+        with open(filename) as ids_file:
+            return sorted(set(int(line) for line in ids_file if line.strip()))
+    except IOError as e:
+        raise CommandError("Could not read %s: %s" % (filename, e))
+    except ValueError:
+        raise CommandError("%s must contain one user id per line." % filename)
+
+
+def cohort_batches(users, batch_size, ids=None):
+    """
+    Yield lists of users from the cohort, a batch at a time.
+    """
+    if ids is not None:
+        for i in range(0, len(ids), batch_size):
+            batch = list(users.filter(id__in=ids[i:i + batch_size]).order_by("id"))
+            if batch:
+                yield batch
+        return
+
+    last_id = 0
+    while True:
+        batch = list(users.filter(id__gt=last_id).order_by("id")[:batch_size])
+        if not batch:
+            return
+        yield batch
+        last_id = batch[-1].id
+
+
+class Command(ProfiledCommand):
+    """
+    Deactivate accounts or force password resets for a cohort of users.
+    """
+    args = "<deactivate|resetpassword>"
+    help = "Deactivates a cohort of users or forces them to reset their passwords."
+    option_list = ProfiledCommand.option_list + (
+        make_option("--filter", dest="filters", action="append", default=[],
+                    help="Select users with a field=value lookup. May be repeated."),
+        make_option("--ids-file", dest="ids_file", default=None,
+                    help="File with one user id per line."),
+        make_option("--batch-size", dest="batch_size", type="int", default=500,
+                    help="Number of users updated per query."),
+        make_option("--rate", dest="rate", type="float", default=0,
+                    help="Maximum number of users per second. 0 means no limit. "
+                         "Batches are made no bigger than this."),
+        make_option("--dry-run", dest="dry_run", action="store_true", default=False,
+                    help="Report how many users would be affected and stop."),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1 or args[0] not in ACTIONS:
+            raise CommandError("Usage: bulkupdateusers %s" % self.args)
+        action = args[0]
+
+        if not options["filters"] and not options["ids_file"]:
+            raise CommandError("Select a cohort with --filter or --ids-file.")
+
+        # Only active accounts are touched. Deactivating an inactive one
+        # is a no-op, and accounts that were never activated shouldn't
+        # get recovery emails: recovering doesn't activate them.
+        try:
+            users = User.objects.filter(**parse_filters(options["filters"])).filter(is_active=True)
+        except FieldError as e:
+            raise CommandError("Bad --filter: %s" % e)
+
+        ids = None
+        if options["ids_file"]:
+            ids = read_ids(options["ids_file"])
+
+        if options["dry_run"]:
+            if ids is not None:
+                total = sum(users.filter(id__in=ids[i:i + options["batch_size"]]).count()
+                            for i in range(0, len(ids), options["batch_size"]))
+            else:
+                total = users.count()
+            self.stdout.write("Would %s %d users.\n" % (action, total))
+            return
+
+        # Keep batches no bigger than one second's worth of users,
+        # so the sleep after each batch holds the rate limit.
+        batch_size = options["batch_size"]
+        if options["rate"] > 0:
+            batch_size = max(1, min(batch_size, int(options["rate"])))
+
+        num = 0
+        start = time.time()
+        for batch in cohort_batches(users, batch_size, ids):
+            if action == "deactivate":
+                self.deactivate(batch)
+            else:
+                self.reset_passwords(batch)
+            num += len(batch)
+
+            elapsed = time.time() - start
+            self.stdout.write("Processed %d users (%.0f users/second).\n"
+                              % (num, num / max(elapsed, 0.001)))
+
+            # Sleep off any time we are ahead of the rate limit.
+            if options["rate"] > 0:
+                ahead = num / options["rate"] - elapsed
+                if ahead > 0:
+                    time.sleep(ahead)
+
+        self.stdout.write("Done. %d users affected.\n" % num)
+
+    def deactivate(self, batch):
+        """
+        Deactivate a batch of users with one UPDATE.
+        """
+        user_ids = [user.id for user in batch]
+        User.objects.filter(id__in=user_ids).update(is_active=False)
+        invalidate_users(user_ids)
+
+    def reset_passwords(self, batch):
+        """
+        Issue recovery keys for a batch of users, send the recovery
+        emails and then make their passwords unusable.
+
+        The passwords are only changed once every email in the batch
+        has been handed to the mail server, so a mail failure never
+        leaves users locked out without a way back in.
+        """
+        managers = [EmailManager(user) for user in batch]
+        recovery_keys = [manager.generate_recovery_key() for manager in managers]
+        AuthenticationKey.objects.bulk_create(recovery_keys)
+        for recovery_key in recovery_keys:
+            key_issued(recovery_key.key)
+
+        emails = [manager.render_recovery_email(recovery_key)
+                  for manager, recovery_key in zip(managers, recovery_keys)]
+        user_ids = [user.id for user in batch]
+        try:
+            get_connection(fail_silently=False).send_messages(emails)
+        except Exception as e:
+            raise CommandError("Sending recovery emails failed (%s). Passwords were not changed "
+                               "for this batch of users: %s. Earlier batches were completed."
+                               % (e, " ".join(str(user_id) for user_id in user_ids)))
+
+        User.objects.filter(id__in=user_ids).update(password=make_password(None))
+        invalidate_users(user_ids)
@@ -1,10 +1,10 @@
-from django.core.management.base import BaseCommand
+from account.profiler import ProfiledCommand
 from django.contrib.auth.models import User
-from settings import DEFAULT_REGISTRATION_KEY_VALID_DAYS
+from account.settings import DEFAULT_REGISTRATION_KEY_VALID_DAYS
 from datetime import datetime, timedelta
 
 
-class Command(BaseCommand):
+class Command(ProfiledCommand):
     """
     Delete users who have failed to activate their accounts.
     """
@@ -0,0 +1,51 @@
+import os
+import time
+from hashlib import sha256
+from optparse import make_option
+
+from account.keyfilter import build_filter, bump_generation, published_stats
+from account.profiler import ProfiledCommand
+
+
+class Command(ProfiledCommand):
+    """
+    Make every server process rebuild its live key filter and
+    report the size and accuracy of a filter built from current data.
+    """
+    args = ""
+    help = "Tells server processes to rebuild the live key filter and reports its memory use and false positive rate."
+    option_list = ProfiledCommand.option_list + (
+        make_option("--probes", dest="probes", type="int", default=10000,
+                    help="Number of random keys used to measure the false positive rate."),
+    )
+
+    def handle(self, *args, **options):
+        generation = bump_generation()
+        self.stdout.write("Server processes will rebuild their filters at their next refresh "
+                          "(generation %d).\n" % generation)
+
+        start = time.time()
+        key_filter = build_filter()
+        elapsed = time.time() - start
+
+        # Random keys are almost certainly not live, so any
+        # hit on one of them is a false positive.
+        probes = options["probes"]
+        false_positives = 0
+        for i in range(probes):
+            if key_filter.might_contain(sha256(os.urandom(32)).hexdigest()):
+                false_positives += 1
+
+        stats = key_filter.stats()
+        self.stdout.write("Loaded %d live keys in %.2f seconds.\n" % (stats["keys"], elapsed))
+        self.stdout.write("Memory: %d bytes per process (%d bits, %d hashes).\n"
+                          % (stats["memory_bytes"], stats["slots"], stats["hashes"]))
+        self.stdout.write("Estimated false positive rate: %.4f (target %.4f).\n"
+                          % (stats["estimated_error_rate"], stats["target_error_rate"]))
+        if probes:
+            self.stdout.write("Measured false positive rate: %.4f over %d probes.\n"
+                              % (float(false_positives) / probes, probes))
+
+        served = published_stats()
+        self.stdout.write("Server processes have looked up %d keys and rejected %d.\n"
+                          % (served["lookups"], served["rejections"]))
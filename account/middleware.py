@@ -0,0 +1,94 @@
+import atexit
+import logging
+import os
+import random
+import threading
+from collections import Counter
+
+from django.core.exceptions import MiddlewareNotUsed
+
+from profiler import StackSampler
+from profiler import write_collapsed
+from settings import ACCOUNT_PROFILE_SAMPLE_RATE
+from settings import ACCOUNT_PROFILE_DIR
+from settings import ACCOUNT_PROFILE_FLUSH_SECONDS
+
+
+logger = logging.getLogger("account.profiler")
+
+
+class AccountProfilerMiddleware(object):
+    """
+    Profile a sample of requests to the account views and keep
+    aggregated collapsed stacks for each view in ACCOUNT_PROFILE_DIR.
+
+    Samples are merged in memory on the request thread. A background
+    thread writes them out every ACCOUNT_PROFILE_FLUSH_SECONDS, so file
+    I/O never slows down or fails a request.
+
+    When ACCOUNT_PROFILE_SAMPLE_RATE is 0 the middleware
+    removes itself at startup and costs nothing.
+    """
+
+    def __init__(self):
+        if not ACCOUNT_PROFILE_SAMPLE_RATE:
+            raise MiddlewareNotUsed
+        self.stacks = {}
+        self.dirty = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.flusher = threading.Thread(target=self.run_flusher)
+        self.flusher.daemon = True
+        self.flusher.start()
+        atexit.register(self.flush)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        """
+        Start sampling if this request is picked.
+        """
+        if view_func.__module__ != "account.views":
+            return None
+        if random.random() >= ACCOUNT_PROFILE_SAMPLE_RATE:
+            return None
+
+        request._account_profile_view = view_func.__name__
+        request._account_profile_sampler = StackSampler()
+        request._account_profile_sampler.start()
+        return None
+
+    def process_response(self, request, response):
+        """
+        Merge the samples into the view's totals.
+        """
+        sampler = getattr(request, "_account_profile_sampler", None)
+        if sampler is None:
+            return response
+
+        view_name = request._account_profile_view
+        samples = sampler.stop()
+        with self.lock:
+            self.stacks.setdefault(view_name, Counter()).update(samples)
+            self.dirty.add(view_name)
+
+        return response
+
+    def run_flusher(self):
+        while not self.stopped.wait(ACCOUNT_PROFILE_FLUSH_SECONDS):
+            self.flush()
+
+    def flush(self):
+        """
+        Write out the totals of every view sampled since the last flush.
+        Errors are logged rather than raised.
+        """
+        with self.lock:
+            pending = [(view_name, Counter(self.stacks[view_name])) for view_name in self.dirty]
+            self.dirty.clear()
+
+        for view_name, stacks in pending:
+            filename = os.path.join(ACCOUNT_PROFILE_DIR,
+                                    "%s.%d.collapsed" % (view_name, os.getpid()))
+            try:
+                write_collapsed(stacks, filename)
+            except (IOError, OSError):
+                logger.exception("Could not write profile to %s.", filename)
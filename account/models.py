@@ -1,6 +1,10 @@
 from django.db import models
+from django.db.models.signals import post_save
+from django.db.models.signals import post_delete
 from django.contrib.auth.models import User
 
+from usercache import invalidate_user_cache
+
 
 KEY_TYPE_CHOICES = (('a', 'Activation'),
                     ('r', 'Recovery'),
@@ -16,3 +20,8 @@ class AuthenticationKey(models.Model):
     key_type = models.CharField(max_length=1, choices=KEY_TYPE_CHOICES)
     used = models.BooleanField()
     expires = models.DateField()
+
+
+# Keep the user cache consistent with the database.
+post_save.connect(invalidate_user_cache, sender=User)
+post_delete.connect(invalidate_user_cache, sender=User)
@@ -0,0 +1,100 @@
+# profiler.py
+# Low overhead sampling profiler producing collapsed stacks
+# that can be fed straight into flamegraph.pl.
+
+import os
+import sys
+import threading
+from collections import Counter
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from settings import ACCOUNT_PROFILE_INTERVAL
+
+
+class StackSampler(object):
+    """
+    Samples the stack of one thread from a background thread.
+    """
+
+    def __init__(self, thread_id=None, interval=ACCOUNT_PROFILE_INTERVAL):
+        """
+        Sample the given thread, or the calling thread
+        if none is given, every interval seconds.
+        """
+        if thread_id is None:
+            thread_id = threading.current_thread().ident
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop sampling and return the collapsed stack counts.
+        """
+        self.stopped.set()
+        self.thread.join()
+        return self.stacks
+
+    def run(self):
+        # Sample once straight away so that even very
+        # short runs record at least one stack.
+        while True:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[collapse(frame)] += 1
+            if self.stopped.wait(self.interval):
+                return
+
+
+def collapse(frame):
+    """
+    Format a stack as semicolon separated frames, outermost first.
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append("%s:%s" % (frame.f_globals.get("__name__", code.co_filename), code.co_name))
+        frame = frame.f_back
+    names.reverse()
+    return ";".join(names)
+
+
+def write_collapsed(stacks, filename):
+    """
+    Write stack counts in the collapsed format, one stack per line.
+    """
+    directory = os.path.dirname(filename)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(filename, "w") as output:
+        for stack, count in stacks.most_common():
+            output.write("%s %d\n" % (stack, count))
+
+
+class ProfiledCommand(BaseCommand):
+    """
+    Management command that can profile itself with --profile.
+    """
+    option_list = BaseCommand.option_list + (
+        make_option("--profile", dest="profile", default=None,
+                    help="Write collapsed stacks of this run to the given file."),
+    )
+
+    def execute(self, *args, **options):
+        if not options.get("profile"):
+            return super(ProfiledCommand, self).execute(*args, **options)
+
+        sampler = StackSampler()
+        sampler.start()
+        try:
+            return super(ProfiledCommand, self).execute(*args, **options)
+        finally:
+            write_collapsed(sampler.stop(), options["profile"])
@@ -8,6 +8,21 @@ EMAIL_ADDRESS_ACTIVATE_ACCOUNT = "activate-account@test.com"
 EMAIL_ADDRESS_RECOVER_PASSWORD = "recover-password@test.com"
 EMAIL_ADDRESS_DEACTIVATE_ACCOUNT = "deactivate-account@test.com"
 
+ACCOUNT_KEY_FILTER_ENABLED = False
+ACCOUNT_KEY_FILTER_CAPACITY = 100000
+ACCOUNT_KEY_FILTER_ERROR_RATE = 0.01
+ACCOUNT_KEY_FILTER_REFRESH_SECONDS = 60
+ACCOUNT_KEY_FILTER_REBUILD_SECONDS = 3600
+
+ACCOUNT_PROFILE_SAMPLE_RATE = 0
+ACCOUNT_PROFILE_INTERVAL = 0.005
+ACCOUNT_PROFILE_DIR = "/tmp/account-profiles"
+ACCOUNT_PROFILE_FLUSH_SECONDS = 10
+
+ACCOUNT_USER_CACHE_SIZE = 1000
+ACCOUNT_USER_CACHE_TTL = 5
+ACCOUNT_USER_CACHE_TIMEOUT = 300
+
 SITE_URL = "/"
 LOGIN_URL = "/account/login/"
 LOGIN_REDIRECT_URL = "/home/"
@@ -0,0 +1,12 @@
+from django.core.cache import cache
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+
+
+def cache_is_shared():
+    """
+    Return True if Django's default cache can be seen by every server
+    process. Local memory and dummy caches are private to one process,
+    so anything written to them never reaches other processes.
+    """
+    return not isinstance(cache, (LocMemCache, DummyCache))
@@ -1,6 +1,32 @@
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import time
+from datetime import date
+from datetime import timedelta
+from StringIO import StringIO
+
 from django.test import TestCase
+from django.test.utils import override_settings
+from django.core.mail.backends.base import BaseEmailBackend
+from django.core.management.base import CommandError
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
 from django.contrib.auth.models import User
 
+import keyfilter
+import sharedcache
+import usercache
+from keyfilter import KeyFilter
+from models import AuthenticationKey
+from export import account_rows
+from profiler import StackSampler
+from usercache import get_cached_user
+from usercache import invalidate_users
+
 
 class AuthenticationTestCase(TestCase):
     """
@@ -150,3 +176,419 @@ class RegistrationTestCase(TestCase):
         response = self.client.get("/account/register/")
         self.assertEquals(response.status_code, 200)
 
+
+
+class KeyFilterTestCase(TestCase):
+    """
+    Tests the live key filter.
+    """
+
+    def setUp(self):
+        self.key_filter = KeyFilter(1000, 0.01)
+        self.key = "a" * 64
+
+    def test_added_key_is_found(self):
+        """
+        A key that has been added is always reported as possibly live.
+        """
+        self.key_filter.add(self.key)
+        self.assertTrue(self.key_filter.might_contain(self.key))
+
+    def test_stats(self):
+        """
+        The filter reports its size and expected error rate.
+        """
+        self.key_filter.add(self.key)
+        self.key_filter.add(self.key)
+        stats = self.key_filter.stats()
+        self.assertEquals(stats["keys"], 1)
+        self.assertEquals(stats["memory_bytes"], (self.key_filter.num_slots + 7) // 8)
+        self.assertTrue(stats["estimated_error_rate"] < 0.01)
+
+    def enable_filter(self, shared):
+        """
+        Turn the filter on, pretending the cache is or isn't shared.
+        """
+        keyfilter.ACCOUNT_KEY_FILTER_ENABLED = True
+        keyfilter.cache_is_shared = lambda: shared
+        return keyfilter.get_key_filter()
+
+    def issue_key_elsewhere(self, key, shared):
+        """
+        Save a key the way another server process would, after
+        this process's filter was built.
+        """
+        user = User.objects.create_user("bob", "bob@test.com", "password")
+        user.is_active = False
+        user.save()
+        AuthenticationKey(user=user, key=key, key_type='a', used=False,
+                          expires=date.today() + timedelta(days=1)).save()
+        if shared:
+            keyfilter.publish_issued_key(key)
+
+    def test_unknown_key_rejected_without_queries(self):
+        """
+        Links with keys that were never issued 404 without
+        hitting the database once the filter is built.
+        """
+        self.enable_filter(shared=True)
+        with self.assertNumQueries(0):
+            response = self.client.get("/account/activate/testuser/%s/" % ("0" * 64))
+        self.assertEquals(response.status_code, 404)
+
+    def test_key_issued_elsewhere_with_shared_cache(self):
+        """
+        A key issued by another process since the last sync
+        is accepted, found through the shared cache.
+        """
+        self.enable_filter(shared=True)
+        self.issue_key_elsewhere("b" * 64, shared=True)
+
+        response = self.client.get("/account/activate/bob/%s/" % ("b" * 64))
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue(User.objects.get(username="bob").is_active)
+
+    def test_key_issued_elsewhere_without_shared_cache(self):
+        """
+        Without a shared cache, keys the filter doesn't
+        hold are looked up in the database.
+        """
+        self.enable_filter(shared=False)
+        self.issue_key_elsewhere("c" * 64, shared=False)
+
+        response = self.client.get("/account/activate/bob/%s/" % ("c" * 64))
+        self.assertEquals(response.status_code, 200)
+
+    def test_rebuilt_when_generation_changes(self):
+        """
+        Running rebuildkeyfilter makes server processes
+        rebuild their filters at their next refresh.
+        """
+        old_filter = self.enable_filter(shared=True)
+        call_command("rebuildkeyfilter", probes=0, stdout=StringIO())
+        old_filter.last_sync = 0
+        self.assertNotEqual(keyfilter.get_key_filter(), old_filter)
+
+    def tearDown(self):
+        keyfilter.ACCOUNT_KEY_FILTER_ENABLED = False
+        keyfilter.cache_is_shared = sharedcache.cache_is_shared
+        keyfilter.key_filter = None
+
+
+class ExportTestCase(TestCase):
+    """
+    Tests the streaming account export.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user("testuser", "test@test.com", "password")
+        self.user.save()
+        self.staff = User.objects.create_user("staffuser", "staff@test.com", "password")
+        self.staff.is_staff = True
+        self.staff.save()
+
+    def test_not_staff(self):
+        """
+        The export is not available to ordinary users.
+        """
+        self.client.login(username="testuser", password="password")
+        response = self.client.get("/account/manage/export/")
+        self.assertEquals(response.status_code, 302)
+
+    def test_csv(self):
+        """
+        The CSV export has a header and one line per user.
+        """
+        self.client.login(username="staffuser", password="password")
+        response = self.client.get("/account/manage/export/")
+        self.assertEquals(response.status_code, 200)
+
+        lines = "".join(response.streaming_content).splitlines()
+        self.assertTrue(lines[0].startswith("id,username,email"))
+        self.assertEquals(len(lines), 3)
+
+    def test_gzipped_jsonl(self):
+        """
+        The JSON lines export can be gzipped on the fly.
+        """
+        self.client.login(username="staffuser", password="password")
+        response = self.client.get("/account/manage/export/?format=jsonl&gzip=1")
+        self.assertEquals(response.status_code, 200)
+
+        data = gzip.GzipFile(fileobj=StringIO("".join(response.streaming_content))).read()
+        rows = [json.loads(line) for line in data.splitlines()]
+        self.assertEquals([row["username"] for row in rows], ["testuser", "staffuser"])
+        self.assertEquals(rows[0]["activation_issued"], 0)
+
+    def test_command(self):
+        """
+        The command writes through its stdout, so the output can be captured.
+        """
+        output = StringIO()
+        call_command("exportaccounts", format="jsonl", stdout=output, stderr=StringIO())
+        rows = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEquals([row["username"] for row in rows], ["testuser", "staffuser"])
+
+    def test_key_history(self):
+        """
+        Keys are counted against the users they belong to.
+        """
+        AuthenticationKey(user=self.user, key="a" * 64, key_type='a',
+                          used=True, expires=date.today()).save()
+        AuthenticationKey(user=self.staff, key="b" * 64, key_type='r',
+                          used=False, expires=date.today() - timedelta(days=1)).save()
+
+        rows = list(account_rows(chunk_size=1))
+        self.assertEquals(rows[0]["activation_issued"], 1)
+        self.assertEquals(rows[0]["activation_used"], 1)
+        self.assertEquals(rows[1]["recovery_issued"], 1)
+        self.assertEquals(rows[1]["recovery_expired"], 1)
+        self.assertEquals(rows[1]["activation_issued"], 0)
+
+    def tearDown(self):
+        self.user.delete()
+        self.staff.delete()
+
+
+class FailingEmailBackend(BaseEmailBackend):
+    """
+    Email backend whose mail server is always down.
+    """
+
+    def send_messages(self, email_messages):
+        raise IOError("Mail server unavailable.")
+
+
+class BulkUpdateUsersTestCase(TestCase):
+    """
+    Tests mass deactivation and forced password resets.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user("testuser", "test@test.com", "password")
+        self.user.save()
+        self.other = User.objects.create_user("otheruser", "other@test.com", "password")
+        self.other.save()
+
+    def test_dry_run(self):
+        """
+        A dry run changes nothing.
+        """
+        call_command("bulkupdateusers", "deactivate", filters=["username=testuser"],
+                     dry_run=True, stdout=StringIO())
+        self.assertTrue(User.objects.get(username="testuser").is_active)
+
+    def test_deactivate(self):
+        """
+        Only the selected users are deactivated.
+        """
+        call_command("bulkupdateusers", "deactivate", filters=["username=testuser"],
+                     stdout=StringIO())
+        self.assertFalse(User.objects.get(username="testuser").is_active)
+        self.assertTrue(User.objects.get(username="otheruser").is_active)
+
+    def test_reset_password(self):
+        """
+        Forced resets disable the old password, issue a recovery
+        key and send a recovery email to every selected user.
+        """
+        call_command("bulkupdateusers", "resetpassword", filters=["is_active=true"],
+                     batch_size=1, stdout=StringIO())
+        self.assertFalse(self.client.login(username="testuser", password="password"))
+        self.assertEquals(AuthenticationKey.objects.filter(key_type='r').count(), 2)
+        self.assertEquals(len(mail.outbox), 2)
+
+    def test_reset_password_skips_inactive(self):
+        """
+        Accounts that were never activated don't get recovery emails.
+        """
+        self.other.is_active = False
+        self.other.save()
+        call_command("bulkupdateusers", "resetpassword", filters=["email__endswith=@test.com"],
+                     stdout=StringIO())
+        self.assertEquals([message.to for message in mail.outbox], [["test@test.com"]])
+
+    def test_operator_errors(self):
+        """
+        A missing ids file or an unknown filter field is reported
+        as a command error rather than a traceback.
+        """
+        # Older versions of Django exit instead of raising CommandError.
+        self.assertRaises((CommandError, SystemExit), call_command, "bulkupdateusers", "deactivate",
+                          ids_file="/nonexistent/ids.txt", stdout=StringIO(), stderr=StringIO())
+        self.assertRaises((CommandError, SystemExit), call_command, "bulkupdateusers", "deactivate",
+                          filters=["nosuchfield=1"], stdout=StringIO(), stderr=StringIO())
+
+    @override_settings(EMAIL_BACKEND="account.tests.FailingEmailBackend")
+    def test_reset_password_mail_failure(self):
+        """
+        Passwords are left alone when the recovery emails can't be sent.
+        """
+        # Older versions of Django exit instead of raising CommandError.
+        self.assertRaises((CommandError, SystemExit), call_command, "bulkupdateusers", "resetpassword",
+                          filters=["username=testuser"], stdout=StringIO(), stderr=StringIO())
+        self.assertTrue(self.client.login(username="testuser", password="password"))
+
+    def tearDown(self):
+        self.user.delete()
+        self.other.delete()
+
+
+class ProfilerTestCase(TestCase):
+    """
+    Tests the sampling profiler.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def test_sampler(self):
+        """
+        The sampler records collapsed stacks of the sampled thread.
+        """
+        sampler = StackSampler(interval=0.001)
+        sampler.start()
+        end = time.time() + 0.05
+        while time.time() < end:
+            pass
+        stacks = sampler.stop()
+
+        self.assertTrue(stacks)
+        self.assertTrue(any("test_sampler" in stack for stack in stacks))
+
+    def test_command_profile(self):
+        """
+        Account commands write collapsed stacks when given --profile.
+        """
+        filename = os.path.join(self.directory, "purge.collapsed")
+        call_command("purgeinactiveusers", profile=filename, stdout=StringIO())
+
+        with open(filename) as output:
+            lines = output.read().splitlines()
+        self.assertTrue(lines)
+        for line in lines:
+            stack, count = line.rsplit(" ", 1)
+            self.assertTrue(stack)
+            self.assertTrue(int(count) > 0)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+class UserCacheTestCase(TestCase):
+    """
+    Tests the cached resolution of session users.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user("testuser", "test@test.com", "password")
+        self.user.save()
+        invalidate_users([self.user.id])
+
+    def load_user(self, user_id):
+        self.loads += 1
+        return User.objects.get(pk=user_id)
+
+    def test_cached(self):
+        """
+        Repeated lookups of the same user don't hit the database.
+        """
+        self.loads = 0
+        get_cached_user(self.user.id, self.load_user)
+        with self.assertNumQueries(0):
+            user = get_cached_user(self.user.id, self.load_user)
+        self.assertEquals(user.username, "testuser")
+        self.assertEquals(self.loads, 1)
+
+    def test_invalidated_on_save(self):
+        """
+        Saving a user, e.g. after a password change, drops it from the cache.
+        """
+        self.loads = 0
+        get_cached_user(self.user.id, self.load_user)
+        self.user.set_password("newpassword")
+        self.user.save()
+
+        user = get_cached_user(self.user.id, self.load_user)
+        self.assertEquals(self.loads, 2)
+        self.assertTrue(user.check_password("newpassword"))
+
+    def test_copies(self):
+        """
+        Changes to a cached user don't leak into later lookups.
+        """
+        self.loads = 0
+        user = get_cached_user(self.user.id, self.load_user)
+        user.is_active = False
+        self.assertTrue(get_cached_user(self.user.id, self.load_user).is_active)
+
+    def test_load_racing_save(self):
+        """
+        A user loaded just before someone else saves it is not
+        put back into the cache after the invalidation.
+        """
+        def load_then_deactivate(user_id):
+            self.loads += 1
+            user = User.objects.get(pk=user_id)
+            User.objects.filter(pk=user_id).update(is_active=False)
+            invalidate_users([user_id])
+            return user
+
+        self.loads = 0
+        self.assertTrue(get_cached_user(self.user.id, load_then_deactivate).is_active)
+        self.assertFalse(get_cached_user(self.user.id, self.load_user).is_active)
+        self.assertEquals(self.loads, 2)
+
+    def test_local_cache_only_when_not_shared(self):
+        """
+        With a cache private to one process, users are only
+        kept in the local cache and never in Django's cache.
+        """
+        usercache.cache_is_shared = lambda: False
+        try:
+            self.loads = 0
+            get_cached_user(self.user.id, self.load_user)
+            self.assertEquals(cache.get(usercache.version_key(self.user.id)), None)
+        finally:
+            usercache.cache_is_shared = sharedcache.cache_is_shared
+
+    @override_settings(AUTHENTICATION_BACKENDS=("account.backends.CachedModelBackend",),
+                       SESSION_ENGINE="django.contrib.sessions.backends.cache")
+    def test_change_password_keeps_other_changes(self):
+        """
+        Changing the password with a cached request.user doesn't
+        undo changes made to the account by another process.
+        """
+        self.assertTrue(self.client.login(username="testuser", password="password"))
+        self.client.get("/account/manage/")
+
+        # Deactivated elsewhere, without this process hearing about it.
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+
+        post_data = {"username": "testuser",
+                     "password": "password",
+                     "new_password": "newpassword",
+                     "confirm_password": "newpassword"}
+        self.client.post("/account/manage/password/", post_data)
+
+        user = User.objects.get(pk=self.user.pk)
+        self.assertTrue(user.check_password("newpassword"))
+        self.assertFalse(user.is_active)
+
+    @override_settings(AUTHENTICATION_BACKENDS=("account.backends.CachedModelBackend",),
+                       SESSION_ENGINE="django.contrib.sessions.backends.cache")
+    def test_manage_account_queries(self):
+        """
+        Once the user is cached, the account management
+        page is served without any queries.
+        """
+        self.assertTrue(self.client.login(username="testuser", password="password"))
+        response = self.client.get("/account/manage/")
+        self.assertEquals(response.status_code, 200)
+
+        with self.assertNumQueries(0):
+            response = self.client.get("/account/manage/")
+        self.assertEquals(response.status_code, 200)
+
+    def tearDown(self):
+        self.user.delete()
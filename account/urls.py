@@ -1,6 +1,7 @@
 from django.conf.urls import patterns, url
 from account.views import login_user, logout_user, change_password, register, \
-    request_recovery, recover_account, activate_account, request_account_deactivation, deactivate_account, manage_account
+    request_recovery, recover_account, activate_account, request_account_deactivation, deactivate_account, manage_account, \
+    export_account_data
 
 urlpatterns = patterns(
     '',
@@ -14,5 +15,6 @@ urlpatterns = patterns(
     url(r'^manage/password/$', change_password),
     url(r'^manage/deactivate/$', request_account_deactivation),
     url(r'^manage/deactivate/(?P<username>\w+)/(?P<key>[a-z0-9]{64})/$', deactivate_account),
+    url(r'^manage/export/$', export_account_data),
 
 )
@@ -0,0 +1,147 @@
+# usercache.py
+# Two level cache of User objects keyed on user id, used to
+# resolve the session user without a query on every request.
+
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import cache
+
+from sharedcache import cache_is_shared
+from settings import ACCOUNT_USER_CACHE_SIZE
+from settings import ACCOUNT_USER_CACHE_TTL
+from settings import ACCOUNT_USER_CACHE_TIMEOUT
+
+
+class LRUCache(object):
+    """
+    Small per-process least recently used cache
+    whose entries expire after ttl seconds.
+
+    Every delete bumps a generation counter. A value loaded
+    before a delete is not stored by set_if_unchanged(), so a
+    slow load can't put back something that was just invalidated.
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.time():
+                return None
+            self.entries[key] = entry
+            return value
+
+    def set_if_unchanged(self, key, value, generation):
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.ttl, value)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.generation += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+
+
+local_cache = LRUCache(ACCOUNT_USER_CACHE_SIZE, ACCOUNT_USER_CACHE_TTL)
+
+
+def version_key(user_id):
+    return "account.user.version.%s" % user_id
+
+
+def cache_key(user_id, version):
+    return "account.user.%s.%s" % (user_id, version)
+
+
+def new_version():
+    """
+    Starting version for a user whose version has never been set
+    or was evicted. Based on the clock so that it can't collide
+    with a version used before the eviction.
+    """
+    return int(time.time() * 1000000)
+
+
+def get_version(user_id):
+    version = cache.get(version_key(user_id))
+    if version is None:
+        cache.add(version_key(user_id), new_version(), None)
+        version = cache.get(version_key(user_id))
+    return version
+
+
+def get_cached_user(user_id, load_user):
+    """
+    Return the user with the given id, trying the local cache,
+    then the Django cache and finally load_user(user_id).
+
+    Entries in the Django cache are stored under the user's current
+    version, which invalidation bumps. A user loaded just before a
+    save is stored under the old version and never read again.
+    The Django cache is skipped if it isn't shared between processes,
+    since invalidations from other processes would never reach it.
+
+    Each caller gets its own copy so that changes made
+    during one request don't leak into another.
+    """
+    user = local_cache.get(str(user_id))
+    if user is None:
+        generation = local_cache.generation
+        if cache_is_shared():
+            version = get_version(user_id)
+            user = cache.get(cache_key(user_id, version))
+            if user is None:
+                user = load_user(user_id)
+                if user is None:
+                    return None
+                cache.set(cache_key(user_id, version), user, ACCOUNT_USER_CACHE_TIMEOUT)
+        else:
+            user = load_user(user_id)
+            if user is None:
+                return None
+        local_cache.set_if_unchanged(str(user_id), user, generation)
+    return copy.deepcopy(user)
+
+
+def invalidate_users(user_ids):
+    """
+    Drop users from both cache levels by bumping their versions.
+    """
+    shared = cache_is_shared()
+    for user_id in user_ids:
+        local_cache.delete(str(user_id))
+        if not shared:
+            continue
+        try:
+            cache.incr(version_key(user_id))
+        except ValueError:
+            cache.set(version_key(user_id), new_version(), None)
+
+
+def invalidate_user_cache(sender, instance, **kwargs):
+    """
+    Signal receiver that drops a user whenever it is saved or
+    deleted, e.g. after set_password, activation or deactivation.
+    """
+    invalidate_users([instance.pk])
@@ -3,7 +3,10 @@ from datetime import datetime
 from django.shortcuts import render_to_response
 from django.shortcuts import get_object_or_404
 from django.http import HttpResponseRedirect
+from django.http import Http404
+from django.http import StreamingHttpResponse
 from django.contrib.auth.decorators import login_required
+from django.contrib.auth.decorators import user_passes_test
 from django.contrib.auth import authenticate
 from django.contrib.auth import login
 from django.contrib.auth import logout
@@ -17,6 +20,9 @@ from forms import RecoveryForm
 from forms import DeactivationForm
 from forms import ResetPasswordForm
 from emailmanager import EmailManager
+from export import EXPORT_FORMATS
+from export import export_accounts
+from keyfilter import key_may_be_live
 from settings import LOGIN_REDIRECT_URL
 from settings import LOGOUT_REDIRECT_URL
 
@@ -68,9 +74,11 @@ def change_password(request):
 
         # If new password is valid, change it and show "changed" page.
         if form.is_valid():
+            # request.user may be a few seconds old if it came from the
+            # user cache, so only write the column that changed.
             user = request.user
             user.set_password(form.cleaned_data["new_password"])
-            user.save()
+            user.save(update_fields=["password"])
             return render_to_response("account/password_changed.html",
                                       context_instance=RequestContext(request))
 
@@ -150,6 +158,10 @@ def recover_account(request, username, key):
     """
     Recover an account.
     """
+    # Reject keys that are definitely not live without a query.
+    if not key_may_be_live(key):
+        raise Http404
+
     # Check if the username belongs to a real user.
     user = get_object_or_404(User, username=username)
 
@@ -190,6 +202,10 @@ def activate_account(request, username, key):
     """
     Activate a new account.
     """
+    # Reject keys that are definitely not live without a query.
+    if not key_may_be_live(key):
+        raise Http404
+
     # Get the user account associated wth the username.
     user = get_object_or_404(User, username=username)
 
@@ -225,8 +241,7 @@ def request_account_deactivation(request):
         if form.is_valid() \
                 and request.user.username == form.cleaned_data["username"]:
             # Send deactivation email
-            user = User.objects.get(username=form.cleaned_data["username"])
-            email_manager = EmailManager(user)
+            email_manager = EmailManager(request.user)
             deactivation_email = email_manager.generate_deactivation_email()
             deactivation_email.send()
 
@@ -246,6 +261,10 @@ def deactivate_account(request, username=None, key=None):
     """
     Deactivate an account.
     """
+    # Reject keys that are definitely not live without a query.
+    if not key_may_be_live(key):
+        raise Http404
+
     # First check if that user exists.
     user = get_object_or_404(User, username=username)
 
@@ -279,3 +298,28 @@ def manage_account(request):
     """
     return render_to_response("account/manage.html",
                               context_instance=RequestContext(request))
+
+
+@user_passes_test(lambda user: user.is_staff)
+def export_account_data(request):
+    """
+    Stream users and their key history to staff.
+    """
+    export_format = request.GET.get("format", "csv")
+    if export_format not in EXPORT_FORMATS:
+        raise Http404
+
+    compress = request.GET.get("gzip") == "1"
+    filename = "accounts.%s" % export_format
+    if compress:
+        filename += ".gz"
+
+    response = StreamingHttpResponse(export_accounts(export_format, compress))
+    if compress:
+        response["Content-Type"] = "application/gzip"
+    elif export_format == "jsonl":
+        response["Content-Type"] = "application/x-ndjson"
+    else:
+        response["Content-Type"] = "text/csv"
+    response["Content-Disposition"] = "attachment; filename=%s" % filename
+    return response